@@ -4,6 +4,11 @@ import usb.util
 import mido
 import array
 import argparse
+import sys
+import time
+import collections
+import heapq
+import threading
 
 # Initialize parser
 parser = argparse.ArgumentParser(
@@ -33,7 +38,7 @@ steam_controller_magic_period_ratio = 495483
 duration_max = -1
 note_stop = -1
 
-midi_frequency = [8.1758, 8.66196, 9.17702, 9.72272, 10.3009, 10.9134, 11.5623, 12.2499, 12.9783, 13.75,
+midi_frequency = (8.1758, 8.66196, 9.17702, 9.72272, 10.3009, 10.9134, 11.5623, 12.2499, 12.9783, 13.75,
 14.5676, 15.4339, 16.3516, 17.3239, 18.354, 19.4454, 20.6017, 21.8268, 23.1247, 24.4997, 25.9565, 27.5,
 29.1352, 30.8677, 32.7032, 34.6478, 36.7081, 38.8909, 41.2034, 43.6535, 46.2493, 48.9994, 51.9131, 55,
 58.2705, 61.7354, 65.4064, 69.2957, 73.4162, 77.7817, 82.4069, 87.3071, 92.4986, 97.9989, 103.826, 110,
@@ -43,7 +48,35 @@ midi_frequency = [8.1758, 8.66196, 9.17702, 9.72272, 10.3009, 10.9134, 11.5623,
 932.328, 987.767, 1046.5, 1108.73, 1174.66, 1244.51, 1318.51, 1396.91, 1479.98, 1567.98, 1661.22, 1760,
 1864.66, 1975.53, 2093, 2217.46, 2349.32, 2489.02, 2637.02, 2793.83, 2959.96, 3135.96, 3322.44, 3520, 3729.31,
 3951.07, 4186.01, 4434.92, 4698.64, 4978.03, 5274.04, 5587.65, 5919.91, 6271.93, 6644.88, 7040, 7458.62,
-7902.13, 8372.02, 8869.84, 9397.27, 9956.06, 10548.1, 11175.3, 11839.8, 12543.9]
+7902.13, 8372.02, 8869.84, 9397.27, 9956.06, 10548.1, 11175.3, 11839.8, 12543.9)
+
+# Pulse period command for every MIDI note, split into LSB and MSB, precomputed once at import
+PERIOD_LO = bytes(int(round(steam_controller_magic_period_ratio/midi_frequency[n])) & 0xFF for n in range(128))
+PERIOD_HI = bytes((int(round(steam_controller_magic_period_ratio/midi_frequency[n])) >> 8) & 0xFF for n in range(128))
+
+# Frequency of every MIDI note in millihertz, for integer repeat count math
+FREQ_MILLI = tuple(int(round(f*1000)) for f in midi_frequency)
+
+# Seconds an infinite note (0x7FFF pulses) keeps playing for every MIDI note, halved as a safety margin
+NOTE_SUSTAIN = tuple(0x7FFF/f/2 for f in midi_frequency)
+
+# Haptic data packet template of 64 bytes, built once and copied into an array.array('B') per packet buffer, described as per in-line comments
+_TEMPLATE = bytearray(64)
+_TEMPLATE[0] = 0x8f
+_TEMPLATE[1] = 0x07
+_TEMPLATE[2] = 0x00 # Trackpad select : 0x01 = left, 0x00 = right
+_TEMPLATE[3] = 0xff # LSB Pulse High Duration
+_TEMPLATE[4] = 0xff # MSB Pulse High Duration
+_TEMPLATE[5] = 0xff # LSB Pulse Low Duration
+_TEMPLATE[6] = 0xff # MSB Pulse Low Duration
+_TEMPLATE[7] = 0xff # LSB Pulse repeat count
+_TEMPLATE[8] = 0x04 # MSB Pulse repeat count
+
+# Maximum amount of notes waiting to be written per Steam Controller
+writer_depth = 16
+
+# Writer of every Steam Controller, keyed by its usb.core.Device object
+_writers = {}
 
 # On Windows, if no backend found:
 # Run 'pip install libusb'
@@ -72,10 +105,79 @@ def find_and_claim_steam_controllers():
 
 def close_steam_controller(steam_controller):
     '''Closes the steam controller usb.core.Device Object'''
+    wait_for_writers([steam_controller])
     usb.core.util.release_interface(steam_controller, 2)
     steam_controller.reset()
 
-def steam_controller_play_note(steam_controller, haptic, note, duration = duration_max):
+class steam_controller_writer(threading.Thread):
+    '''
+    Plays queued notes on a single Steam Controller from its own thread, so USB writes never stall MIDI timing
+
+    At most writer_depth notes are kept, on overflow the oldest note queued for the same haptic is dropped
+    '''
+    def __init__(self, steam_controller, depth = writer_depth):
+        threading.Thread.__init__(self, daemon=True)
+        self.steam_controller = steam_controller
+        self.depth = depth
+        # haptic, note, duration
+        self.pending = collections.deque()
+        self.unfinished = 0
+        self.condition = threading.Condition()
+        # only this thread writes to the controller, so one packet buffer is reused for every note,
+        # as an array.array so pyusb passes it to libusb without copying it
+        self.data_packet = array.array('B', _TEMPLATE)
+
+    def put(self, haptic, note, duration = duration_max):
+        with self.condition:
+            if len(self.pending) >= self.depth:
+                for i in range(len(self.pending)):
+                    if self.pending[i][0] == haptic:
+                        del self.pending[i]
+                        break
+                else:
+                    self.pending.popleft()
+                self.unfinished -= 1
+            self.pending.append((haptic, note, duration))
+            self.unfinished += 1
+            self.condition.notify_all()
+
+    def join_pending(self):
+        '''Blocks until every queued note has been written'''
+        with self.condition:
+            while self.unfinished:
+                self.condition.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                haptic, note, duration = self.pending.popleft()
+            try:
+                steam_controller_play_note(self.steam_controller, haptic, note, duration, self.data_packet)
+            except Exception as e:
+                print('[ERROR] Unable to play note: ' + str(e))
+            finally:
+                with self.condition:
+                    self.unfinished -= 1
+                    self.condition.notify_all()
+
+def steam_controller_writer_for(steam_controller):
+    '''Returns the writer of the Steam Controller, starting its thread on first use'''
+    writer = _writers.get(steam_controller)
+    if writer is None:
+        writer = _writers[steam_controller] = steam_controller_writer(steam_controller)
+        writer.start()
+    return writer
+
+def wait_for_writers(controllers):
+    '''Blocks until every queued note has been written to the given Steam Controllers'''
+    for controller in controllers:
+        writer = _writers.get(controller)
+        if writer is not None:
+            writer.join_pending()
+
+def steam_controller_play_note(steam_controller, haptic, note, duration = duration_max, data_packet = None):
     '''
     Plays a note on the Steam Controller
 
@@ -86,67 +188,91 @@ def steam_controller_play_note(steam_controller, haptic, note, duration = durati
     note is the note to play (Follows MIDI standard)
 
     duration is the duration of the note in milliseconds (default: -1 = infinite)
+
+    data_packet is an optional array.array('B') copy of _TEMPLATE to reuse, only bytes 2 to 8 are overwritten (default: None = new copy)
     '''
     
-    # data packet is a list of 64 bytes, and is described as per in-line comments
-
-    data_packet = [0x8f,
-                0x07,
-                0x00, # Trackpad select : 0x01 = left, 0x00 = right
-                0xff, # LSB Pulse High Duration
-                0xff, # MSB Pulse High Duration
-                0xff, # LSB Pulse Low Duration
-                0xff, # MSB Pulse Low Duration
-                0xff, # LSB Pulse repeat count
-                0x04, # MSB Pulse repeat count
-                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
-                
     if note == note_stop:
         note = 0
         duration = 0
+    # MIDI notes are 7 bit, masking keeps any out of range note a valid table index
+    note &= 0x7F
     
-    frequency = midi_frequency[note]
-    period = 1/frequency
-    period_command = period * steam_controller_magic_period_ratio
+    if data_packet is None:
+        # pyusb copies any other buffer type into an array.array('B') before the transfer
+        data_packet = array.array('B', _TEMPLATE)
+
+    lo = PERIOD_LO[note]
+    hi = PERIOD_HI[note]
 
-    repeat_count = duration/period if duration >= 0 else 0x7FFF
+    repeat_count = (duration*FREQ_MILLI[note] + 500) // 1000 if duration >= 0 else 0x7FFF
 
     # Assign variables to data packet
 
     data_packet[2] = haptic
-    data_packet[3] = int(period_command % 256)
-    data_packet[4] = int(period_command / 256)
-    data_packet[5] = int(period_command % 256)
-    data_packet[6] = int(period_command / 256)
-    data_packet[7] = int(repeat_count % 256)
-    data_packet[8] = int(repeat_count / 256)
+    data_packet[3] = data_packet[5] = lo
+    data_packet[4] = data_packet[6] = hi
+    data_packet[7] = repeat_count & 0xFF
+    data_packet[8] = (repeat_count >> 8) & 0xFF
 
+    # pyusb loads libusb through ctypes.CDLL, which releases the GIL for the duration of the transfer,
+    # so MIDI parsing on other threads keeps running while a writer thread waits on the USB round trip
     try:
-        steam_controller.ctrl_transfer(0x21,9,0x0300,2,array.array('B',data_packet),1000)
+        steam_controller.ctrl_transfer(0x21,9,0x0300,2,data_packet,1000)
     except usb.core.USBError as e:
         print('[ERROR] Unable to write to interface: ' + str(e))
 
+def _display_line(channel):
+    '''Builds the haptic labels up to channel followed by the tab prefix of channel's note column'''
+    labels = ''.join('\r'+'\t'*(i*3) + ("RIGHT Haptic {}:".format(i//2 + 1) if i%2 == 0 else "LEFT Haptic {}:".format(i//2 + 1)) for i in range(channel+1))
+    return labels + '\r'+'\t'*((channel*3)+2)
+
+# Display line prefix for every channel, grown on demand as channels are displayed
+_display_lines = []
+
+# Seconds between writes of the buffered display to stdout
+display_flush_interval = 1/30
+# Display text waiting to be written, shared with the display thread
+_display_pending = []
+_display_lock = threading.Lock()
+
+def flush_display():
+    '''Writes all buffered display text to stdout in a single write and flush'''
+    with _display_lock:
+        if not _display_pending:
+            return
+        text = ''.join(_display_pending)
+        _display_pending.clear()
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+def _display_writer():
+    '''Flushes the buffered display at most once per display_flush_interval'''
+    while True:
+        time.sleep(display_flush_interval)
+        flush_display()
+
+threading.Thread(target=_display_writer, daemon=True).start()
+
+# Display name of every MIDI note, and of a stopped haptic
+_NOTE_NAMES = (" C","C#"," D","D#"," E"," F","F#"," G","G#"," A","A#"," B")
+_NOTE_STR = tuple(_NOTE_NAMES[n % 12] + str(n//12 - 1) for n in range(128))
+_NOTE_STR_OFF = 'OFF'
+
 def display_played_notes(channel, note):
-    if note == note_stop:
-        note_str = 'OFF'
-    else:
-        note_names = [" C","C#"," D","D#"," E"," F","F#"," G","G#"," A","A#"," B"]
-        note_str = note_names[note % 12] + str(int(note/12)-1)
-        # print(note_str)
+    note_str = _NOTE_STR_OFF if note == note_stop else _NOTE_STR[note]
 
-    controller_output = '\r'
-    for i in list(range(channel+1)):
-        print('\r'+'\t'*(i*3) + ("RIGHT Haptic {}:".format(int(i/2 + 1)) if i%2 == 0 else "LEFT Haptic {}:".format(int((i-1)/2 +1))), end='')
-    print(controller_output, end='')
-    print('\r'+'\t'*(((channel)*3)+2)+note_str, end='')
+    while len(_display_lines) <= channel:
+        _display_lines.append(_display_line(len(_display_lines)))
+    # display lines contain '\r', which flushes a line buffered tty on every write, so buffer them here instead
+    with _display_lock:
+        _display_pending.append(_display_lines[channel] + note_str)
 
 def tune(controller):
     for i in range(128):
         display_played_notes(0, i)
         steam_controller_play_note(controller, 0, i)
+        flush_display()
         input('Press Enter to continue...')
 
 def play_song(controllers,song,logic):
@@ -154,85 +280,97 @@ def play_song(controllers,song,logic):
     mid = mido.MidiFile(song)
     print('Now Playing:',song)
     try: 
+        # playback is single threaded, so skip send()'s lock and message copy
         for msg in mid.play():
-            port.send(msg)
+            port._send(msg)
     except KeyboardInterrupt:
+        flush_display()
         print('\nStopping...')
         port.send(mido.Message('stop'))
+    wait_for_writers(port.controllers)
+    flush_display()
 
 class steam_controller_mido_port(mido.ports.BaseOutput):
     def __init__(self, controllers, debug = False, logic = 'single_voice'):
         mido.ports.BaseOutput.__init__(self)
         self.controllers = controllers
-        if type(controllers) is not list:
-            self.controllers = [self.controllers]
+        self.writers = [steam_controller_writer_for(controller) for controller in self.controllers]
         self.channels = len(self.controllers)*2-1
-        # channel, note
-        self.previous_notes = [0]* (self.channels+1)
+        # writer, haptic for every haptic index
+        self.slot_map = tuple((self.writers[i >> 1], i & 1) for i in range(self.channels+1))
+        # last note queued on every haptic index, None until the haptic is first written, and when it was queued
+        self.previous_notes = [None]* (self.channels+1)
+        self.previous_times = [0]* (self.channels+1)
         self.debug = debug
         self.logic = logic
-        self.queue = [None]*(self.channels+1)
+        # (channel, note) -> haptic index currently playing it, and a heap of the haptic indexes left to allocate
+        self.active = {}
+        self.free = list(range(self.channels+1))
         
+    def play(self, i, note):
+        '''Queues the note on haptic index i (see slot_map), skipping stops on already silent haptics
+        and repeats of a note whose pulse train is still playing (see NOTE_SUSTAIN)'''
+        now = time.monotonic()
+        if self.previous_notes[i] == note:
+            if note == note_stop or now - self.previous_times[i] < NOTE_SUSTAIN[note & 0x7F]:
+                return
+        self.previous_notes[i] = note
+        self.previous_times[i] = now
+        writer, haptic = self.slot_map[i]
+        writer.put(haptic, note)
+
     def single_voice(self, msg):
         '''This implementation of the midi is used for Midi exports inwhere each haptic pad has
         its own unique midi channel assigned to it. In this manner it is possible to pop notes, as the missing
         note_off event can be assumed, in order to play the most recent note and not hang on a longer duration.
         However, this does not support channel polyphony, polyphony can still be achived by writing one note per
         channel, however, this it is often tedius to rewrite music, and is not recommended.'''
-        if msg.channel <= self.channels:
-            controller,haptic = msg.channel // 2, msg.channel % 2
-            if msg.type == 'note_on':
+        channel = msg.channel
+        if channel <= self.channels:
+            mtype = msg.type
+            play = self.play
+            if mtype == 'note_on':
                 if msg.velocity == 0:
-                    steam_controller_play_note(self.controllers[controller], haptic, note_stop)
-                    display_played_notes(msg.channel, note_stop)
+                    play(channel, note_stop)
+                    display_played_notes(channel, note_stop)
                 else:
-                    display_played_notes(msg.channel, msg.note)
-                    steam_controller_play_note(self.controllers[controller], haptic, msg.note)
-            elif msg.type == 'note_off':
-                steam_controller_play_note(self.controllers[controller], haptic, note_stop)
-                display_played_notes(msg.channel, note_stop)
+                    note = msg.note
+                    display_played_notes(channel, note)
+                    play(channel, note)
+            elif mtype == 'note_off':
+                play(channel, note_stop)
+                display_played_notes(channel, note_stop)
     
     def polyphony(self, msg):
         '''This implementation of parsing midi data is optimized for a midi keyboard, and as such behaves as expected. However,
         it is not possible to pop old notes in order to make new notes, as expected for a synth that runs out of voices.'''
-        if msg.type == 'note_on':
-            if msg.velocity == 0:
-                # Musescore sends its note_off events as velocity = 0
-                for i in range(len(self.queue)):
-                    if self.queue[i] is not None:
-                        if self.queue[i]['channel'] == msg.channel and self.queue[i]['note'] == msg.note:
-                            controller,haptic = i // 2, i % 2
-                            steam_controller_play_note(self.controllers[controller], haptic, note_stop)
-                            display_played_notes(i, note_stop)
-                            self.queue[i] = None
-                            break
-            else:
-                for i in range(len(self.queue)):
-                    if self.queue[i] == None:
-                        # populate index with msg metadata
-                        self.queue[i] = {
-                            'channel': msg.channel,
-                            'note': msg.note
-                        }
-                        controller, haptic = i // 2, i % 2
-                        steam_controller_play_note(self.controllers[controller], haptic, msg.note)
-                        display_played_notes(i, msg.note)
-                        break
-        elif msg.type == 'note_off':
-            for i in range(len(self.queue)):
-                if self.queue[i] is not None:
-                    if self.queue[i]['channel'] == msg.channel and self.queue[i]['note'] == msg.note:
-                        controller,haptic = i // 2, i % 2
-                        steam_controller_play_note(self.controllers[controller], haptic, note_stop)
-                        display_played_notes(i, note_stop)
-                        self.queue[i] = None
-                        break
+        mtype = msg.type
+        if mtype != 'note_on' and mtype != 'note_off':
+            return
+        key = (msg.channel, msg.note)
+        active = self.active
+        if mtype == 'note_on' and msg.velocity != 0:
+            # a repeated note_on without note_off keeps its haptic, otherwise take the lowest free one
+            i = active.get(key)
+            if i is None and self.free:
+                i = active[key] = heapq.heappop(self.free)
+            if i is not None:
+                self.play(i, key[1])
+                display_played_notes(i, key[1])
+        else:
+            # Musescore sends its note_off events as velocity = 0
+            i = active.pop(key, None)
+            if i is not None:
+                heapq.heappush(self.free, i)
+                self.play(i, note_stop)
+                display_played_notes(i, note_stop)
     
     def _send(self, msg):
         if msg.type == 'stop':
+            # queue every stop first so all controllers are written in parallel, then wait once
             for i in range(self.channels+1):
-                controller,haptic = i // 2, i % 2
-                steam_controller_play_note(self.controllers[controller], haptic, note_stop)
+                self.play(i, note_stop)
+            wait_for_writers(self.controllers)
 
         if self.logic == 'single_voice':
             self.single_voice(msg)
@@ -245,22 +383,24 @@ controllers = find_and_claim_steam_controllers()
     
 print('[INFO] {} Steam Controller found'.format(len(controllers)))
 
-if args.file == None:
-    if args.midi_input_port == None:
+if args.file is None:
+    if args.midi_input_port is None:
         try:
             midi_keyboard = mido.open_input(mido.get_input_names()[0])
         except IndexError:
             print('[WARNING] No midi keyboards found')
             exit()
-    elif type(args.midi_input_port) == str:
-        midi_keyboard = port = mido.open_input(args.midi_input_port)
+    else:
+        midi_keyboard = mido.open_input(args.midi_input_port)
     print('[READY] Listening to midi keyboard:',midi_keyboard.name)
     output_port = steam_controller_mido_port(controllers,logic='polyphony')
     for msg in midi_keyboard:
         try:
             output_port.send(msg)
         except KeyboardInterrupt:
+            flush_display()
             print('\nStopping...')
             output_port.send(mido.Message('stop'))
-elif type(args.file) == str:
+            wait_for_writers(controllers)
+else:
     play_song(controllers, args.file, args.logic)
\ No newline at end of file